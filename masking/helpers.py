@@ -4,7 +4,9 @@ import numpy as np
 from skbeam.core.accumulators.binned_statistic import BinnedStatistic1D
 from skbeam.core.mask import margin
 
-from masking.jittools import mask_ring_mean, mask_ring_median
+from masking.jittools import (
+    mask_ring_mean, mask_ring_median, mask_rings_median
+)
 
 mask_ring_dict = {"median": mask_ring_median, "mean": mask_ring_mean}
 
@@ -121,7 +123,8 @@ def mask_img(
         The starting mask to be compounded on. Defaults to None. If None mask
         generated from scratch.
     pool : Executor instance
-        A pool against which jobs can be submitted for parallel processing
+        A pool against which jobs can be submitted for parallel processing.
+        See `binned_outlier` for when to pass one.
 
     Returns
     -------
@@ -173,39 +176,49 @@ def binned_outlier(
         The method to use for creating the mask, median is faster, mean is more
         accurate. Defaults to median.
     pool : Executor instance
-        A pool against which jobs can be submitted for parallel processing
+        A pool against which jobs can be submitted for parallel processing.
+        If None, 'median' runs all the rings in one compiled parallel loop
+        and 'mean' uses a new thread pool. The parallel loop must not be
+        launched from several threads at once, so callers running their own
+        threads should pass a pool, which runs the rings one by one in it.
 
     Returns
     -------
     np.ndarray:
         The mask
     """
-    if pool is None:
-        pool = ThreadPoolExecutor(max_workers=20)
     # skbeam 0.0.12 doesn't have argsort_index cached
     idx = binner.argsort_index
     tmsk = flatten(tmsk)
     tmsk2 = tmsk[idx]
     vfs = flatten(img)[idx]
     pfs = np.arange(np.size(img))[idx]
-    t = []
-    i = 0
-    for k in binner.flatcount:
-        m = tmsk2[i: i + k]
-        vm = vfs[i: i + k][m]
-        if k > 0 and len(vm) > 0:
-            t.append((vm, (pfs[i: i + k][m]), alpha))
-        i += k
     p_err = np.seterr(all="ignore")
-    # only run tqdm on mean since it is slow
-    with pool as p:
-        futures = [
-            p.submit(mask_ring_dict[mask_method], *x)
-            for x in t
-        ]
-    removals = []
-    for f in as_completed(futures):
-        removals.extend(f.result())
+    if mask_method == "median" and pool is None:
+        # all the rings are done in one compiled parallel loop
+        counts = np.asarray(binner.flatcount)
+        starts = np.cumsum(counts) - counts
+        removals = pfs[mask_rings_median(vfs, tmsk2, starts, counts, alpha)]
+    else:
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=20)
+        t = []
+        i = 0
+        for k in binner.flatcount:
+            m = tmsk2[i: i + k]
+            vm = vfs[i: i + k][m]
+            if k > 0 and len(vm) > 0:
+                t.append((vm, (pfs[i: i + k][m]), alpha))
+            i += k
+        # only run tqdm on mean since it is slow
+        with pool as p:
+            futures = [
+                p.submit(mask_ring_dict[mask_method], *x)
+                for x in t
+            ]
+        removals = []
+        for f in as_completed(futures):
+            removals.extend(f.result())
     np.seterr(**p_err)
     tmsk[removals] = False
     tmsk = tmsk.reshape(np.shape(img))
@@ -1,7 +1,7 @@
 """Just in time compiled tools (seperated from tools so we don't keep
 compiling them"""
 import numpy as np
-from numba import jit, boolean
+from numba import jit, boolean, prange
 
 
 @jit(cache=True, nopython=True, nogil=True)
@@ -27,6 +27,50 @@ def mask_ring_median(values_array, positions_array, alpha):  # pragma: no cover
     return removals
 
 
+@jit(
+    cache=True, nopython=True, nogil=True, parallel=True, error_model="numpy"
+)
+def mask_rings_median(
+    values_array, good_array, starts_array, counts_array, alpha
+):  # pragma: no cover
+    """Find outlier pixels in all the rings via a single pass with the median,
+    running the rings in parallel.
+
+    Parameters
+    ----------
+    values_array : ndarray
+        The values of all the pixels, sorted by the ring
+    good_array : ndarray
+        The prior mask of the sorted pixels, True pixels are used
+    starts_array : ndarray
+        The index of the first pixel of each ring
+    counts_array : ndarray
+        The number of pixels in each ring
+    alpha: float
+        The threshold
+
+    Returns
+    -------
+    outliers: np.ndarray
+        The boolean array of the sorted pixels, True pixels are to be removed
+        from the data
+    """
+    outliers = np.zeros(values_array.shape, dtype=boolean)
+    for b in prange(starts_array.shape[0]):
+        start = starts_array[b]
+        stop = start + counts_array[b]
+        good = good_array[start:stop]
+        vm = values_array[start:stop][good]
+        if vm.size == 0:
+            continue
+        z = np.abs(vm - np.median(vm)) / np.std(vm)
+        idx = np.where(good)[0]
+        for j in range(vm.size):
+            if z[j] > alpha:
+                outliers[start + idx[j]] = True
+    return outliers
+
+
 @jit(cache=True, nopython=True, nogil=True)
 def mask_ring_mean(values_array, positions_array, alpha):  # pragma: no cover
     """Find outlier pixels in a single ring via a pixel by pixel method with
@@ -0,0 +1,33 @@
+import numpy as np
+
+from masking.helpers import binned_outlier, map_to_binner
+from masking.jittools import mask_ring_median
+
+
+def test_binned_outlier_median():
+    # rings at 0.5, 1.5, 3.5 and 4.5, the ring between 2 and 3 is empty
+    q = np.repeat([0.5, 1.5, 3.5, 4.5], 25).reshape(4, 25)
+    bins = np.arange(6.)
+    binner = map_to_binner(q, bins)
+    rng = np.random.default_rng(0)
+    img = rng.normal(10., 1., q.shape)
+    img[0, 3] = 100.
+    img[3, 7] = -50.
+    tmsk = np.ones(q.shape, dtype=bool)
+    # the ring at 3.5 is fully masked
+    tmsk[2] = False
+    tmsk[1, 5] = False
+    expected = tmsk.flatten()
+    flat_q, flat_img = q.flatten(), img.flatten()
+    for lo, hi in zip(bins[:-1], bins[1:]):
+        sel = (flat_q >= lo) & (flat_q < hi) & tmsk.flatten()
+        if sel.any():
+            removals = mask_ring_median(
+                flat_img[sel], np.nonzero(sel)[0], 3.
+            )
+            expected[removals] = False
+    result = binned_outlier(
+        img, binner, tmsk, alpha=3., mask_method="median"
+    )
+    assert not result[0, 3] and not result[3, 7]
+    assert np.array_equal(result, expected.reshape(q.shape))
@@ -1,5 +1,10 @@
-from pkg_resources import resource_filename
+import os
+try:
+    from importlib.resources import files
+except ImportError:  # python < 3.9
+    from importlib_resources import files
 
+import pytest
 from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
 import matplotlib.pyplot as plt
 import fabio
@@ -8,8 +13,8 @@ import numpy as np
 
 plt.ioff()
 
-TIFF_FILE = resource_filename("masking", "data/image.tiff")
-PONI_FILE = resource_filename("masking", "data/geo.poni")
+TIFF_FILE = str(files("masking").joinpath("data/image.tiff"))
+PONI_FILE = str(files("masking").joinpath("data/geo.poni"))
 
 
 def test_auto_mask():
@@ -30,8 +35,123 @@ def test_auto_mask_files(tmp_path):
     )
     mask = fabio.open(str(mask_file)).data
     image = fabio.open(str(TIFF_FILE)).data
-    masked_image = np.ma.masked_array(image, 1 - mask)
+    masked_image = np.ma.masked_array(image, np.logical_not(mask))
     del mask, image
     plt.imshow(masked_image)
     plt.colorbar()
     plt.show(block=False)
+
+
+def test_load_ai_cached():
+    mtime = os.path.getmtime(PONI_FILE)
+    assert tools._load_ai(PONI_FILE, mtime) is tools._load_ai(PONI_FILE, mtime)
+    binner = tools._load_binner(PONI_FILE, mtime, (2048, 2048))
+    assert tools._load_binner(PONI_FILE, mtime, (2048, 2048)) is binner
+
+
+def test_auto_mask_files_parallel(tmp_path):
+    mask_files = tools.auto_mask_files(
+        [TIFF_FILE],
+        PONI_FILE,
+        str(tmp_path.joinpath("masks")),
+        mask_setting={"alpha": 3.},
+        n_workers=1
+    )
+    assert mask_files == [str(tmp_path.joinpath("masks", "image.msk"))]
+    mask_file = tmp_path.joinpath("serial.msk")
+    tools.auto_mask_file(
+        TIFF_FILE,
+        PONI_FILE,
+        str(mask_file),
+        mask_setting={"alpha": 3.}
+    )
+    assert np.array_equal(
+        fabio.open(mask_files[0]).data,
+        fabio.open(str(mask_file)).data
+    )
+
+
+def test_auto_mask_files_duplicate_names(tmp_path):
+    with pytest.raises(ValueError):
+        tools.auto_mask_files(
+            ["a/image.tiff", "b/image.tiff"],
+            PONI_FILE,
+            str(tmp_path)
+        )
+
+
+def test_vis_img_reuse_axes():
+    fig = plt.figure()
+    img = np.random.rand(4, 4)
+    ax = tools.vis_img(img, show=False, fig=fig)
+    assert tools.vis_img(img + 1., show=False, fig=fig) is ax
+    assert len(fig.axes) == 2
+    chi = np.stack([np.arange(4), np.arange(4)])
+    assert tools.vis_chi(chi, show=False, fig=fig) is not ax
+    assert len(fig.axes) == 1
+
+
+def test_vis_img_array_setting():
+    fig = plt.figure()
+    img = np.random.rand(4, 4)
+    ax = tools.vis_img(
+        img, img_setting={"extent": np.array([0, 1, 0, 1])},
+        show=False, fig=fig
+    )
+    ax2 = tools.vis_img(
+        img, img_setting={"extent": np.array([0, 1, 0, 1])},
+        show=False, fig=fig
+    )
+    assert ax2 is not ax
+    assert len(fig.axes) == 2
+
+
+def test_vis_img_failed_plot():
+    fig = plt.figure()
+    img = np.random.rand(4, 4)
+    with pytest.raises((AttributeError, TypeError)):
+        tools.vis_img(
+            img, img_setting={"no_such_kwarg": 1}, show=False, fig=fig
+        )
+    ax = tools.vis_img(img, show=False, fig=fig)
+    assert tools.vis_img(img, show=False, fig=fig) is ax
+
+
+def test_mean_std():
+    arr = np.random.randint(0, 2 ** 16, size=(5, 7), dtype=np.uint16)
+    mean, std = tools._mean_std(arr)
+    assert np.isclose(mean, arr.mean())
+    assert np.isclose(std, arr.std())
+
+
+def test_read_tiff():
+    pytest.importorskip("tifffile")
+    image = tools.read_tiff(TIFF_FILE)
+    assert isinstance(image, np.memmap)
+    assert np.array_equal(image, fabio.open(TIFF_FILE).data)
+
+
+def test_vis_img_mask():
+    img = np.arange(16.).reshape(4, 4)
+    mask = np.zeros((4, 4), dtype=np.uint8)
+    mask[0, 0] = 1
+    ax = tools.vis_img(img, mask, show=False)
+    shown = ax.images[0].get_array()
+    assert np.ma.is_masked(shown[0, 0]) or np.isnan(shown[0, 0])
+    assert shown[1, 1] == img[1, 1]
+
+
+def test_bg_sub():
+    img = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    bg_img = np.full((3, 4), 2, dtype=np.uint16)
+    expect = img - 0.5 * bg_img
+    assert np.array_equal(tools.bg_sub(img, bg_img, 0.5), expect)
+    assert np.array_equal(tools.bg_sub(img, bg_img), img - 1. * bg_img)
+    out = np.empty((3, 4))
+    assert tools.bg_sub(img, bg_img, 0.5, out=out) is out
+    assert np.array_equal(out, expect)
+    img = img.astype(float)
+    assert tools.bg_sub(img, bg_img, 0.5, out=img) is img
+    assert np.array_equal(img, expect)
+    with pytest.raises(ValueError):
+        tools.bg_sub(bg_img, bg_img, 0.5, out=bg_img)
@@ -1,10 +1,15 @@
 """The functions used in the integration pipelines. All functions consume namespace and return the modified
 namespace. """
-from typing import Tuple
-from pathlib import PurePath
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple
+from pathlib import Path, PurePath
+import multiprocessing
+import os
 import shutil
 
 import matplotlib.pyplot as plt
+import numba
 import numpy as np
 import pyFAI
 from matplotlib.axes import Axes
@@ -13,9 +18,15 @@ import fabio
 from fabio.fit2dmaskimage import Fit2dMaskImage
 from numpy import ndarray
 from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
+from skbeam.core.accumulators.binned_statistic import BinnedStatistic1D
 
 from masking.helpers import generate_binner, mask_img
 
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
 INTEG_SETTING = dict(
     npt=3000,
     correctSolidAngle=False,
@@ -34,19 +45,24 @@ _LABEL = {
 
 
 def to_numpy(pixel_array):
-    if ((pixel_array is not None) and (not isinstance(pixel_array, ndarray))):
-        if not hasattr(pixel_array, 'to_numpy'):
-            raise TypeError("Attempting to use a pixel grid of type({}) as "
-                            "where a numpy.ndarray is expected without a "
-                            "known way of converting the given pixel array to "
-                            "a numpy.ndarray."
-                            .format(type(pixel_array)))
-        pixel_array = pixel_array.to_numpy()
-    return pixel_array
-
-
-def bg_sub(img: ndarray, bg_img: ndarray, bg_scale: float = None) -> ndarray:
-    """Subtract the background image from the data image inplace.
+    # fast path for the common case that the pixel array is already an ndarray
+    if pixel_array.__class__ is ndarray or pixel_array is None:
+        return pixel_array
+    if isinstance(pixel_array, ndarray):
+        return pixel_array
+    if not hasattr(pixel_array, 'to_numpy'):
+        raise TypeError("Attempting to use a pixel grid of type({}) as "
+                        "where a numpy.ndarray is expected without a "
+                        "known way of converting the given pixel array to "
+                        "a numpy.ndarray."
+                        .format(type(pixel_array)))
+    return pixel_array.to_numpy()
+
+
+def bg_sub(
+    img: ndarray, bg_img: ndarray, bg_scale: float = None, out: ndarray = None
+) -> ndarray:
+    """Subtract the background image from the data image.
 
     Parameters
     ----------
@@ -58,12 +74,35 @@ def bg_sub(img: ndarray, bg_img: ndarray, bg_scale: float = None) -> ndarray:
 
     bg_scale : float
         The scale of the the background image.
+
+    out : ndarray
+        The array to write the result into. Pass `img` to subtract inplace. It must be a float array because the
+        result is a float. If None, a new array is allocated.
+
+    Returns
+    -------
+    out : ndarray
+        The background subtracted image.
     """
     if bg_scale is None:
         bg_scale = 1.
     if bg_img.shape != img.shape:
         raise ValueError(f"Unmatched shape between two images: {bg_img.shape}, {img.shape}.")
-    return img - bg_scale * bg_img
+    res_dtype = np.result_type(img, bg_img, bg_scale)
+    if out is None:
+        out = np.empty(img.shape, dtype=res_dtype)
+    elif not np.can_cast(res_dtype, out.dtype, 'same_kind'):
+        raise ValueError(f"Cannot write the background subtracted image of {res_dtype} into an array of {out.dtype}.")
+    if bg_scale == 1:
+        # no scaling needed, subtract in the output dtype so integer images do not wrap around
+        np.subtract(img, bg_img, out=out, dtype=out.dtype)
+    elif np.may_share_memory(out, img):
+        np.subtract(img, np.multiply(bg_img, bg_scale), out=out)
+    else:
+        # scale the background into the output buffer so only one array is allocated
+        np.multiply(bg_img, bg_scale, out=out)
+        np.subtract(img, out, out=out)
+    return out
 
 
 def integrate(
@@ -93,18 +132,66 @@ def integrate(
     _integ_setting: dict
         The whole integration setting.
     """
-    img  = to_numpy(img)
-    mask = to_numpy(mask)
-    # merge integrate setting
-    _integ_setting = INTEG_SETTING.copy()
-    if integ_setting is not None:
-        _integ_setting.update(integ_setting)
+    img = to_numpy(img)
+    # merge integrate setting in a single new dict, the caller owns the returned one
+    if integ_setting:
+        _integ_setting = {**INTEG_SETTING, **integ_setting}
+    else:
+        _integ_setting = INTEG_SETTING.copy()
     # integrate
-    xy = ai.integrate1d(img, mask=mask, **_integ_setting)
+    if mask is None:
+        xy = ai.integrate1d(img, **_integ_setting)
+    else:
+        xy = ai.integrate1d(img, mask=to_numpy(mask), **_integ_setting)
     chi = np.stack(xy)
     return chi, _integ_setting
 
 
+def _mean_std(arr: ndarray) -> Tuple[float, float]:
+    """Calculate the mean and the standard deviation of the array from the sum and the sum of squares, which are
+    accumulated in float64 so that integer images do not overflow."""
+    flat = np.ravel(arr)
+    n = flat.size
+    mean = flat.sum(dtype=np.float64) / n
+    sq_mean = np.einsum('i,i->', flat, flat, dtype=np.float64) / n
+    std = np.sqrt(max(sq_mean - mean * mean, 0.))
+    return mean, std
+
+
+def _cached_axes(fig: Figure, kind: str) -> Optional[dict]:
+    """Get the cache of the axes that the last visualization of this kind made on the figure. Return None if there is
+    no such axes or the figure has been modified since then."""
+    cache = getattr(fig, '_masking_vis', None)
+    if cache is None or cache['kind'] != kind or cache['ax'] not in fig.axes:
+        return None
+    return cache
+
+
+def _same_setting(setting: dict, other: dict) -> bool:
+    """Check if the two visualization settings are the same. Values that cannot be compared as a single bool, such as
+    arrays, are only the same if they are the same object."""
+    if setting.keys() != other.keys():
+        return False
+    for key, value in setting.items():
+        if value is other[key]:
+            continue
+        try:
+            if not bool(value == other[key]):
+                return False
+        except (ValueError, TypeError):
+            return False
+    return True
+
+
+def _new_axes(fig: Figure, kind: str) -> dict:
+    """Clear the figure, add a new axes to it and start a new cache of the axes for this kind of visualization. The
+    caller stores the cache on the figure once the plot is done, so a failed plot never leaves a half-filled cache."""
+    for axis in fig.axes:
+        fig.delaxes(axis)
+    fig.clear()
+    return {'kind': kind, 'ax': fig.add_subplot(111)}
+
+
 def vis_img(img: ndarray,
             mask: ndarray = None,
             img_setting: dict = None,
@@ -120,7 +207,7 @@ def vis_img(img: ndarray,
         The 2D diffraction image array.
 
     mask: ndarray
-        The whole integration setting.
+        The mask as a 0 and 1 array. 0 pixels are good pixels, 1 pixels are masked out.
 
     img_setting : dict
         The user's modification to imshow kwargs except a special key 'z_score'.
@@ -135,29 +222,45 @@ def vis_img(img: ndarray,
     """
     if img_setting is None:
         img_setting = dict()
-    if fig is None:
-        fig = plt.figure()
-    else:
-        for axis in fig.axes:
-            fig.delaxes(axis)
-        fig.clear()
-    ax: Axes = fig.add_subplot(111)
     if mask is not None:
-        img = np.ma.masked_array(img, mask)
-    mean, std = img.mean(), img.std()
+        # plain ndarray reductions on the good pixels are much cheaper than np.ma
+        good = np.logical_not(mask)
+        mean, std = _mean_std(img[good])
+        # matplotlib leaves NaN pixels blank, the same as masked pixels
+        img = np.where(good, img, np.nan)
+    else:
+        mean, std = _mean_std(img)
     z_score = img_setting.pop('z_score', 2.)
     kwargs = {
         'vmin': mean - z_score * std,
         'vmax': mean + z_score * std
     }
     kwargs.update(**img_setting)
-    img_obj = ax.matshow(img, **kwargs)
-    ax.set_xticks([])
-    ax.set_yticks([])
-    ax.set_xticklabels([])
-    ax.set_yticklabels([])
-    # color bar with magical settings to make it same size as the plot
-    plt.colorbar(img_obj, ax=ax, fraction=0.046, pad=0.04)
+    if fig is None:
+        fig = plt.figure()
+    cache = _cached_axes(fig, 'img')
+    if (cache is not None and cache['img'].get_array().shape == img.shape
+            and _same_setting(cache['setting'], img_setting)):
+        # same kind of plot on the same figure, only update the pixels and the color limits
+        ax = cache['ax']
+        img_obj = cache['img']
+        img_obj.set_data(img)
+        # the colorbar listens to the image, set_clim already updates it
+        img_obj.set_clim(kwargs['vmin'], kwargs['vmax'])
+        fig.canvas.draw_idle()
+    else:
+        cache = _new_axes(fig, 'img')
+        ax = cache['ax']
+        img_obj = ax.matshow(img, **kwargs)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        ax.set_xticklabels([])
+        ax.set_yticklabels([])
+        # color bar with magical settings to make it same size as the plot
+        plt.colorbar(img_obj, ax=ax, fraction=0.046, pad=0.04)
+        cache['img'] = img_obj
+        cache['setting'] = img_setting.copy()
+        fig._masking_vis = cache
     if show:
         plt.show(block=False)
     return ax
@@ -194,15 +297,18 @@ def vis_chi(chi: ndarray,
         plot_setting = dict()
     if fig is None:
         fig = plt.figure()
+    cache = _cached_axes(fig, 'chi')
+    if cache is not None:
+        ax = cache['ax']
+        ax.cla()
     else:
-        for axis in fig.axes:
-            fig.delaxes(axis)
-        fig.clear()
-    ax = fig.add_subplot(111)
+        cache = _new_axes(fig, 'chi')
+        ax = cache['ax']
     ax.plot(chi[0], chi[1], **plot_setting)
     if unit:
         ax.set_xlabel(_LABEL.get(unit))
     ax.set_ylabel('I (A. U.)')
+    fig._masking_vis = cache
     if show:
         plt.show(block=False)
     return ax
@@ -212,7 +318,8 @@ def auto_mask(
     img: ndarray,
     ai: AzimuthalIntegrator,
     user_mask: ndarray = None,
-    mask_setting: dict = None
+    mask_setting: dict = None,
+    binner: BinnedStatistic1D = None
 ) -> ndarray:
     """Automatically generate the mask of the image.
 
@@ -230,22 +337,69 @@ def auto_mask(
     user_mask : ndarray
         A mask provided by user. It is an integer array. 0 are good pixels, 1 are masked out.
 
+    binner : BinnedStatistic1D
+        The binner of the pixels for the geometry in `ai`. If None, it is generated from `ai` and the image shape.
+
     Returns
     -------
     mask : ndarray
-        The mask as an integer array. 0 are good pixels, 1 are masked out.
+        The mask as an uint8 array. 1 are good pixels, 0 are masked out.
     """
     if mask_setting is not None:
         _mask_setting = mask_setting
     else:
         _mask_setting = dict()
-    binner = generate_binner(ai, img.shape)
+    if binner is None:
+        binner = generate_binner(ai, img.shape)
     tmsk = user_mask.astype(bool) if user_mask is not None else None
+    # thresholding does not need double precision, so float64 images are halved to float32 for the binned statistics
+    if img.dtype == np.float64:
+        img = img.astype(np.float32)
     mask = mask_img(img, binner, tmsk=tmsk, **_mask_setting)
-    mask = mask.astype(int)
+    mask = mask.astype(np.uint8)
     return mask
 
 
+def read_tiff(tiff_file: str) -> ndarray:
+    """Read the first frame in the tiff file. An uncompressed 2D frame in the native byte order is memory-mapped if the
+    optional dependency tifffile is installed, otherwise it is read by fabio.
+
+    Parameters
+    ----------
+    tiff_file : str
+        The path to the tiff file.
+
+    Returns
+    -------
+    image : ndarray
+        The 2D diffraction image array. It is read-only if it is memory-mapped.
+    """
+    if tifffile is not None:
+        try:
+            image = tifffile.memmap(tiff_file, page=0, mode='r')
+        except ValueError:
+            # the image data is compressed or not contiguous in the file
+            image = None
+        # numba does not accept a non-native byte order, so leave those files to fabio
+        if image is not None and image.ndim == 2 and image.dtype.isnative:
+            return image
+    return fabio.open(tiff_file).data
+
+
+@lru_cache(maxsize=2)
+def _load_ai(poni_file: str, poni_mtime: float) -> AzimuthalIntegrator:
+    """Load the AzimuthalIntegrator from the poni file. The modification time is part of the cache key so that an
+    edited poni file is loaded again."""
+    return pyFAI.load(poni_file)
+
+
+@lru_cache(maxsize=2)
+def _load_binner(poni_file: str, poni_mtime: float, img_shape: Tuple[int, ...]) -> BinnedStatistic1D:
+    """Generate the binner for the geometry in the poni file and the image shape. It is cached the same way as the
+    AzimuthalIntegrator."""
+    return generate_binner(_load_ai(poni_file, poni_mtime), img_shape)
+
+
 def auto_mask_file(
         tiff_file: str,
         poni_file: str,
@@ -261,16 +415,88 @@ def auto_mask_file(
     mask_file = str(PurePath(mask_file))
     user_file = str(PurePath(user_file)) if user_file else None
     # load the data
-    image = fabio.open(tiff_file).data
-    ai = pyFAI.load(poni_file)
+    image = read_tiff(tiff_file)
+    poni_mtime = os.path.getmtime(poni_file)
+    ai = _load_ai(poni_file, poni_mtime)
+    binner = _load_binner(poni_file, poni_mtime, image.shape)
     user_mask = fabio.open(user_file).data if user_file else None
     # run auto masking
-    mask = auto_mask(image, ai, user_mask, mask_setting)
+    mask = auto_mask(image, ai, user_mask, mask_setting, binner=binner)
     # save the mask
     save_fit2dmask(mask_file, mask)
     return
 
 
+def _init_worker(poni_file: str, n_threads: int) -> None:
+    """Load the AzimuthalIntegrator once in a worker process so that the tasks reuse it. Limit the threads of the
+    parallel numba functions so that all the workers together do not use more threads than the cores."""
+    numba.set_num_threads(n_threads)
+    _load_ai(poni_file, os.path.getmtime(poni_file))
+    return
+
+
+def auto_mask_files(
+        tiff_files: Sequence[str],
+        poni_file: str,
+        out_dir: str,
+        user_file: str = None,
+        mask_setting: dict = None,
+        n_workers: int = None
+) -> List[str]:
+    """Automatically mask the tiff files in parallel processes and save the masks in the output directory. The worker
+    processes are spawned, so a script calling this function needs the `if __name__ == "__main__":` guard.
+
+    Parameters
+    ----------
+    tiff_files : Sequence[str]
+        The paths to the tiff files of the images. All of them share the same geometry.
+
+    poni_file : str
+        The path to the poni file of the geometry.
+
+    out_dir : str
+        The directory to save the masks. It is created if it does not exist. The mask of "image.tiff" is saved as
+        "image.msk", so the tiff files must have different names.
+
+    user_file : str
+        The path to the mask provided by user. If None, no user mask is used.
+
+    mask_setting : dict
+        The user's modification to auto-masking settings.
+
+    n_workers : int
+        The number of worker processes. If None, use the number of processors.
+
+    Returns
+    -------
+    mask_files : List[str]
+        The paths to the mask files in the same order as the tiff files.
+    """
+    out_path = Path(out_dir)
+    mask_files = [str(out_path.joinpath(PurePath(f).stem + ".msk")) for f in tiff_files]
+    if len(set(mask_files)) != len(mask_files):
+        names = sorted({f for f in mask_files if mask_files.count(f) > 1})
+        raise ValueError(f"Tiff files with the same name would overwrite each other's mask: {names}.")
+    out_path.mkdir(parents=True, exist_ok=True)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_threads = max(1, numba.config.NUMBA_NUM_THREADS // n_workers)
+    # forked workers can be killed when numba's threading layer was already started in the parent
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(str(PurePath(poni_file)), n_threads)
+    ) as executor:
+        futures = [
+            executor.submit(auto_mask_file, tiff_file, poni_file, mask_file, user_file, mask_setting)
+            for tiff_file, mask_file in zip(tiff_files, mask_files)
+        ]
+        for future in futures:
+            future.result()
+    return mask_files
+
+
 def save_fit2dmask(filename: str, data: np.ndarray) -> None:
     image_obj = Fit2dMaskImage(data)
     image_obj.write(filename)